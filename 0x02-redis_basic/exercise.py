@@ -1,22 +1,142 @@
 #!/usr/bin/env python3
 '''A module for using the Redis NoSQL data storage.
 '''
+from collections import deque
 from functools import wraps
-from typing import Any, Callable, Union
+from itertools import chain
+from typing import Any, Callable, Iterator, List, Optional, Tuple, Union
+import msgpack
+import os
+import queue
 import redis
-import uuid
+import sys
+import threading
+
+
+_POOLS = {}
+_REDIS_SOCKET = os.environ.get('REDIS_SOCKET')
+_STORE_KEY = b'Cache.store'
+_STORE_INPUTS_KEY = _STORE_KEY + b':inputs'
+_STORE_OUTPUTS_KEY = _STORE_KEY + b':outputs'
+_STORE_HISTORY_KEY = _STORE_KEY + b':history'
+_REPLAY_CHUNK = 1000
+_KEYS_PER_REFILL = 4096
+_spare_keys = deque()
+_WRITES = queue.Queue()
+_writer_lock = threading.Lock()
+_writer = None
+_STORE_SCRIPT = '''
+local limit = tonumber(ARGV[1])
+redis.call('SET', KEYS[1], ARGV[2])
+for i = 2, #ARGV - 1 do
+    redis.call('RPUSH', KEYS[i], ARGV[i + 1])
+    if limit > 0 then
+        redis.call('LTRIM', KEYS[i], -limit, -1)
+    end
+end
+if #KEYS > #ARGV - 1 then
+    redis.call('INCR', KEYS[#KEYS])
+end
+return KEYS[1]
+'''
+
+
+def _default_pool(decode_responses: bool = False) -> redis.ConnectionPool:
+    '''Returns the connection pool shared by the Cache instances, which
+    goes through the Unix domain socket named by the REDIS_SOCKET
+    environment variable when it is set and through TCP otherwise.
+    Responses are decoded to strings by the client's parser when
+    decode_responses is set. Past its 32 connections, callers wait up to
+    10 seconds for one to be free.
+    '''
+    if decode_responses not in _POOLS:
+        if _REDIS_SOCKET:
+            pool = redis.BlockingConnectionPool(
+                connection_class=redis.UnixDomainSocketConnection,
+                path=_REDIS_SOCKET,
+                max_connections=32,
+                timeout=10,
+                decode_responses=decode_responses,
+            )
+        else:
+            pool = redis.BlockingConnectionPool(
+                host='localhost',
+                port=6379,
+                max_connections=32,
+                timeout=10,
+                decode_responses=decode_responses,
+            )
+        _POOLS[decode_responses] = pool
+    return _POOLS[decode_responses]
+
+
+def _bytes_pool(pool: redis.ConnectionPool) -> redis.ConnectionPool:
+    '''Returns a connection pool to the same server as the given one
+    whose responses are left as bytes, which is the given pool itself
+    unless it decodes them.
+    '''
+    if not pool.connection_kwargs.get('decode_responses'):
+        return pool
+    if pool is _POOLS.get(True):
+        return _default_pool(False)
+    return pool.__class__(
+        connection_class=pool.connection_class,
+        max_connections=pool.max_connections,
+        **dict(pool.connection_kwargs, decode_responses=False),
+    )
+
+
+def _new_key() -> str:
+    '''Returns a random key for a stored value. The keys are cut from
+    one large read of the kernel's random bytes, which is done again
+    once they have all been handed out.
+    '''
+    try:
+        return _spare_keys.popleft()
+    except IndexError:
+        random_hex = os.urandom(16 * _KEYS_PER_REFILL).hex()
+        _spare_keys.extend(
+            random_hex[i:i + 32] for i in range(32, len(random_hex), 32)
+        )
+        return random_hex[:32]
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_spare_keys.clear)
+
+
+def _as_str(value: Union[str, bytes]) -> str:
+    '''Returns a value read from Redis as a string, decoding it unless
+    the client already did.
+    '''
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _push_history(
+        pipe: redis.client.Pipeline,
+        key: bytes,
+        entries: list,
+        limit: Optional[int],
+        ) -> None:
+    '''Queues the appending of entries to a call history list, followed
+    by the trimming of the list to its most recent entries if limited.
+    '''
+    pipe.rpush(key, *entries)
+    if limit:
+        pipe.ltrim(key, -limit, -1)
 
 
 def count_calls(method: Callable) -> Callable:
     '''Tracks the number of calls made to a method in a Cache class.
     '''
+    qualname = method.__qualname__.encode()
+
     @wraps(method)
     def wrapper(self, *args, **kwargs) -> Any:
         '''returns the given method after incrementing its call counter.
         '''
-
         if isinstance(self._redis, redis.Redis):
-            self._redis.incr(method.__qualname__)
+            self._redis.incr(qualname)
         return method(self, *args, **kwargs)
 
     return wrapper
@@ -25,63 +145,348 @@ def count_calls(method: Callable) -> Callable:
 def call_history(method: Callable) -> Callable:
     '''Tracks the call details of a method in a Cache class.
     '''
+    in_key = '{}:inputs'.format(method.__qualname__).encode()
+    out_key = '{}:outputs'.format(method.__qualname__).encode()
+    history_key = '{}:history'.format(method.__qualname__).encode()
+
     @wraps(method)
     def invoker(self, *args, **kwargs) -> Any:
         '''Returns the method's output after storing its inputs and output.
         '''
-        in_key = '{}:inputs'.format(method.__qualname__)
-        out_key = '{}:outputs'.format(method.__qualname__)
-        if isinstance(self._redis, redis.Redis):
-            self._redis.rpush(in_key, str(args))
+        if not isinstance(self._redis, redis.Redis):
+            return method(self, *args, **kwargs)
+        limit = getattr(self, 'HISTORY_LIMIT', None)
+        if getattr(self, 'HISTORY_MODE', 'lists') == 'compact':
+            output = method(self, *args, **kwargs)
+            with self._redis.pipeline(transaction=False) as pipe:
+                _push_history(
+                    pipe, history_key, [_pack_call(args, output)], limit,
+                )
+                pipe.execute()
+            return output
+        with self._redis.pipeline(transaction=False) as pipe:
+            _push_history(pipe, in_key, [str(args)], limit)
+            pipe.execute()
         output = method(self, *args, **kwargs)
-        if isinstance(self._redis, redis.Redis):
-            self._redis.rpush(out_key, output)
+        with self._redis.pipeline(transaction=False) as pipe:
+            _push_history(pipe, out_key, [output], limit)
+            pipe.execute()
         return output
     return invoker
 
 
+def _iter_history(
+        redis_store: redis.Redis,
+        in_key: str,
+        out_key: str,
+        fxn_inputs: List[bytes],
+        fxn_outputs: List[bytes],
+        ) -> Iterator[Tuple[str, str]]:
+    '''Yields the inputs and outputs of a call history kept in two
+    lists, starting with their first chunk and fetching the next ones
+    from Redis a chunk at a time.
+    '''
+    start = 0
+    while True:
+        for fxn_input, fxn_output in zip(fxn_inputs, fxn_outputs):
+            yield _as_str(fxn_input), _as_str(fxn_output)
+        if len(fxn_inputs) < _REPLAY_CHUNK:
+            return
+        start += _REPLAY_CHUNK
+        end = start + _REPLAY_CHUNK - 1
+        with redis_store.pipeline(transaction=False) as pipe:
+            pipe.lrange(in_key, start, end)
+            pipe.lrange(out_key, start, end)
+            fxn_inputs, fxn_outputs = pipe.execute()
+
+
+def _pack_call(args: tuple, output: Any) -> bytes:
+    '''Returns the inputs and output of a call packed as a single call
+    history entry. Values msgpack cannot encode are packed as strings.
+    '''
+    return msgpack.packb((args, output), default=str)
+
+
+def _unpack_call(fxn_call: bytes) -> Tuple[str, str]:
+    '''Returns the inputs and output of a packed call history entry.
+    '''
+    fxn_args, fxn_output = msgpack.unpackb(fxn_call, use_list=False)
+    return repr(fxn_args), str(fxn_output)
+
+
+def _iter_compact_history(
+        redis_store: redis.Redis,
+        history_key: str,
+        fxn_calls: List[bytes],
+        ) -> Iterator[Tuple[str, str]]:
+    '''Yields the inputs and outputs of a call history kept as packed
+    entries in a single list, starting with its first chunk and fetching
+    the next ones from Redis a chunk at a time.
+    '''
+    start = 0
+    while True:
+        yield from map(_unpack_call, fxn_calls)
+        if len(fxn_calls) < _REPLAY_CHUNK:
+            return
+        start += _REPLAY_CHUNK
+        fxn_calls = redis_store.lrange(
+            history_key,
+            start,
+            start + _REPLAY_CHUNK - 1,
+        )
+
+
 def replay(fn: Callable) -> None:
     '''Displays the call history of a Cache class' method.
+    The history kept in the two legacy lists is displayed before the one
+    kept in the compact list, so both storage modes can be replayed.
+    Calls are in order within each mode, but not across them: when
+    HISTORY_MODE was changed between calls, every call recorded in the
+    lists is displayed before every compact one, whenever it was made.
+    '''
+    if fn is None or not hasattr(fn, '__self__'):
+        return
+    redis_store = getattr(fn.__self__, '_history_redis', None)
+    if not isinstance(redis_store, redis.Redis):
+        return
+    fxn_name = fn.__qualname__
+    in_key = '{}:inputs'.format(fxn_name)
+    out_key = '{}:outputs'.format(fxn_name)
+    history_key = '{}:history'.format(fxn_name)
+    with redis_store.pipeline(transaction=False) as pipe:
+        pipe.get(fxn_name)
+        pipe.lrange(in_key, 0, _REPLAY_CHUNK - 1)
+        pipe.lrange(out_key, 0, _REPLAY_CHUNK - 1)
+        pipe.lrange(history_key, 0, _REPLAY_CHUNK - 1)
+        fxn_call_count, fxn_inputs, fxn_outputs, fxn_calls = pipe.execute()
+    fxn_history = chain(
+        _iter_history(redis_store, in_key, out_key, fxn_inputs, fxn_outputs),
+        _iter_compact_history(redis_store, history_key, fxn_calls),
+    )
+    _write_history(fxn_name, int(fxn_call_count or 0), fxn_history)
+
+
+def replay_and_drain(fn: Callable) -> None:
+    '''Displays the call history of a Cache class' method like replay,
+    in the same order, then deletes it along with the method's call
+    counter. The history is read and deleted atomically, so no call is
+    lost in between.
     '''
     if fn is None or not hasattr(fn, '__self__'):
         return
-    redis_store = getattr(fn.__self__, '_redis', None)
+    redis_store = getattr(fn.__self__, '_history_redis', None)
     if not isinstance(redis_store, redis.Redis):
         return
     fxn_name = fn.__qualname__
     in_key = '{}:inputs'.format(fxn_name)
     out_key = '{}:outputs'.format(fxn_name)
-    fxn_call_count = 0
-    if redis_store.exists(fxn_name) != 0:
-        fxn_call_count = int(redis_store.get(fxn_name))
-    print('{} was called {} times:'.format(fxn_name, fxn_call_count))
-    fxn_inputs = redis_store.lrange(in_key, 0, -1)
-    fxn_outputs = redis_store.lrange(out_key, 0, -1)
-    for fxn_input, fxn_output in zip(fxn_inputs, fxn_outputs):
-        print('{}(*{}) -> {}'.format(
-            fxn_name,
-            fxn_input.decode("utf-8"),
-            fxn_output,
-        ))
+    history_key = '{}:history'.format(fxn_name)
+    with redis_store.pipeline(transaction=True) as pipe:
+        pipe.get(fxn_name)
+        pipe.lrange(in_key, 0, -1)
+        pipe.lrange(out_key, 0, -1)
+        pipe.lrange(history_key, 0, -1)
+        pipe.delete(fxn_name, in_key, out_key, history_key)
+        fxn_call_count, fxn_inputs, fxn_outputs, fxn_calls, _ = pipe.execute()
+    fxn_history = chain(
+        (
+            (_as_str(fxn_input), _as_str(fxn_output))
+            for fxn_input, fxn_output in zip(fxn_inputs, fxn_outputs)
+        ),
+        map(_unpack_call, fxn_calls),
+    )
+    _write_history(fxn_name, int(fxn_call_count or 0), fxn_history)
+
+
+def _write_history(
+        fxn_name: str,
+        fxn_call_count: int,
+        fxn_history: Iterator[Tuple[str, str]],
+        ) -> None:
+    '''Writes the call count and the call history of a method to the
+    standard output, a chunk of lines at a time.
+    '''
+    line_prefix = '{}(*'.format(fxn_name)
+    lines = ['{} was called {} times:\n'.format(fxn_name, fxn_call_count)]
+    for fxn_input, fxn_output in fxn_history:
+        lines.append(line_prefix + fxn_input + ') -> ' + fxn_output + '\n')
+        if len(lines) >= _REPLAY_CHUNK:
+            sys.stdout.write(''.join(lines))
+            lines = []
+    sys.stdout.write(''.join(lines))
+
+
+def _drain_writes() -> None:
+    '''Executes the writes queued by all the Cache instances, in order,
+    as they arrive. The errors raised by a write are kept in the error
+    list of the Cache that queued it, for Cache.wait_writes, and never
+    stop the thread.
+    '''
+    while True:
+        write, kwargs, errors = _WRITES.get()
+        try:
+            write(**kwargs)
+        except Exception as error:
+            errors.append(error)
+
+
+def _start_writer() -> None:
+    '''Starts the background thread shared by the asynchronous Cache
+    instances, unless it is already running.
+    '''
+    global _writer
+    if _writer is not None:
+        return
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_drain_writes, daemon=True)
+            _writer.start()
+
+
+def _reset_writer() -> None:
+    '''Forgets the writer thread and its queue in a forked child, which
+    only inherits them from its parent without the running thread.
+    '''
+    global _WRITES, _writer_lock, _writer
+    _WRITES = queue.Queue()
+    _writer_lock = threading.Lock()
+    _writer = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_writer)
 
 
 class Cache:
     '''Represents an object for storing data in a Redis data storage.
+    By default, it connects to the local Redis server through TCP on
+    localhost:6379, or through the Unix domain socket named by the
+    REDIS_SOCKET environment variable when it is set. The call history
+    of store is kept either in two lists of inputs and outputs ('lists')
+    or as one packed entry per call in a single list ('compact'),
+    depending on HISTORY_MODE. The history is always read back as
+    bytes, since the compact entries are not valid UTF-8 strings.
+    Counting and recording the calls of store can be turned off with
+    _track_count and _track_history. Only the last HISTORY_LIMIT calls
+    are kept in the history, or all of them when it is None.
     '''
+    HISTORY_MODE = 'lists'
+    HISTORY_LIMIT = 1000
+    _track_count = True
+    _track_history = True
 
-    def __init__(self) -> None:
-        self._redis = redis.Redis()
-        self._redis.flushdb(True)
+    def __init__(
+            self,
+            pool: redis.ConnectionPool = None,
+            flush: bool = False,
+            async_writes: bool = False,
+            url: str = None,
+            decode_responses: bool = False,
+            ) -> None:
+        '''Initializes a Cache on the Redis server at the given URL or
+        on the given connection pool, which defaults to a pool shared by
+        all the instances of this module. With flush, the database is
+        emptied first. With async_writes, store returns without waiting
+        for the server and its writes are sent by a background thread
+        shared by all the instances.
+        With decode_responses, the values read from the default pool or
+        URL are returned as strings instead of bytes.
+        '''
+        if url is not None:
+            self._redis = redis.Redis.from_url(
+                url,
+                decode_responses=decode_responses,
+            )
+        else:
+            self._redis = redis.Redis(
+                connection_pool=pool or _default_pool(decode_responses),
+            )
+        self._get = self._redis.get
+        self._history_redis = redis.Redis(
+            connection_pool=_bytes_pool(self._redis.connection_pool),
+        )
+        if flush:
+            self._redis.flushdb(asynchronous=True)
+        self._store_script = self._redis.register_script(_STORE_SCRIPT)
+        self._async_writes = async_writes
+        self._write_errors = []
+        if async_writes:
+            _start_writer()
+
+    def _write(self, write: Callable, **kwargs) -> None:
+        '''Executes a write to the Redis data storage, or queues it for
+        the background thread when the writes are asynchronous.
+        '''
+        if self._async_writes:
+            _start_writer()
+            _WRITES.put((write, kwargs, self._write_errors))
+        else:
+            write(**kwargs)
+
+    def wait_writes(self) -> None:
+        '''Blocks until all the writes queued by this Cache have been
+        executed and raises the first Redis error any of them ran into.
+        '''
+        if self._async_writes:
+            _start_writer()
+            done = threading.Event()
+            _WRITES.put((done.set, {}, self._write_errors))
+            done.wait()
+        if self._write_errors:
+            error = self._write_errors[0]
+            del self._write_errors[:]
+            raise error
 
-    @call_history
-    @count_calls
-    def store(self, data:  Union[str, bytes, int, float]) -> str:
+    def store(self, data: Union[str, bytes, int, float]) -> str:
         '''Stores a value in a Redis data storage and returns the key.
+        The value, the call counter and the call history are written
+        atomically by a server-side script in one round-trip.
         '''
-        data_key = str(uuid.uuid4())
-        self._redis.set(data_key, data)
+        data_key = _new_key()
+        keys = [data_key]
+        args = [self.HISTORY_LIMIT or 0, data]
+        if self._track_history:
+            if self.HISTORY_MODE == 'compact':
+                keys.append(_STORE_HISTORY_KEY)
+                args.append(_pack_call((data,), data_key))
+            else:
+                keys.extend((_STORE_INPUTS_KEY, _STORE_OUTPUTS_KEY))
+                args.extend((b'(' + repr(data).encode() + b',)', data_key))
+        if self._track_count:
+            keys.append(_STORE_KEY)
+        self._write(self._store_script, keys=keys, args=args)
         return data_key
 
+    def store_many(
+            self,
+            datas: List[Union[str, bytes, int, float]],
+            ) -> List[str]:
+        '''Stores several values in a Redis data storage and returns
+        their keys, in order. The values, the call counter and the call
+        history are all written in a single round-trip to the server.
+        '''
+        data_keys = [_new_key() for _ in datas]
+        if not data_keys:
+            return data_keys
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.mset(dict(zip(data_keys, datas)))
+        if self._track_count:
+            pipe.incrby(_STORE_KEY, len(data_keys))
+        if self._track_history and self.HISTORY_MODE == 'compact':
+            _push_history(pipe, _STORE_HISTORY_KEY, [
+                _pack_call((data,), data_key)
+                for data, data_key in zip(datas, data_keys)
+            ], self.HISTORY_LIMIT)
+        elif self._track_history:
+            _push_history(pipe, _STORE_INPUTS_KEY, [
+                b'(' + repr(data).encode() + b',)' for data in datas
+            ], self.HISTORY_LIMIT)
+            _push_history(
+                pipe, _STORE_OUTPUTS_KEY, data_keys, self.HISTORY_LIMIT,
+            )
+        self._write(pipe.execute)
+        return data_keys
+
     def get(
             self,
             key: str,
@@ -89,15 +494,17 @@ class Cache:
             ) -> Union[str, bytes, int, float]:
         '''Retrieves a value from a Redis data storage.
         '''
-        data = self._redis.get(key)
+        data = self._get(key)
         return fn(data) if fn is not None else data
 
     def get_str(self, key: str) -> str:
         '''Retrieves a string value from a Redis data storage.
         '''
-        return self.get(key, lambda x: x.decode('utf-8'))
+        data = self._get(key)
+        return None if data is None else _as_str(data)
 
     def get_int(self, key: str) -> int:
         '''Retrieves an integer value from a Redis data storage.
         '''
-        return self.get(key, lambda x: int(x))
\ No newline at end of file
+        data = self._get(key)
+        return None if data is None else int(data)
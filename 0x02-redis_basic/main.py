@@ -6,7 +6,7 @@ import redis
 
 Cache = __import__('exercise').Cache
 
-cache = Cache()
+cache = Cache(flush=True)
 
 # data = b"hello"
 # key = cache.store(data)
@@ -3,50 +3,621 @@
 Expiring web cache and access tracker
 """
 
+import asyncio
 import redis
-import requests
+import redis.asyncio as aioredis
+import httpx
 import hashlib
-from functools import wraps
-from typing import Callable
+import math
+import msgpack
+import os
+import atexit
+import logging
+import queue
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from functools import lru_cache, wraps
+from itertools import chain, islice, repeat
+from typing import (
+    Any, Callable, Iterable, Iterator, List, Mapping, Optional, Tuple,
+)
 
-r = redis.Redis()
+# Set REDIS_SOCKET to reach a colocated Redis over its Unix socket. Past
+# max_connections, callers wait up to timeout seconds for a free one.
+_REDIS_SOCKET = os.environ.get("REDIS_SOCKET")
+if _REDIS_SOCKET:
+    _POOL = redis.BlockingConnectionPool(
+        connection_class=redis.UnixDomainSocketConnection,
+        path=_REDIS_SOCKET,
+        max_connections=64,
+        timeout=10,
+        decode_responses=False,
+        socket_timeout=5,
+        health_check_interval=30,
+    )
+else:
+    _POOL = redis.BlockingConnectionPool(
+        host="localhost",
+        port=6379,
+        max_connections=64,
+        timeout=10,
+        decode_responses=False,
+        socket_timeout=5,
+        socket_connect_timeout=5,
+        socket_keepalive=True,
+        health_check_interval=30,
+    )
+r = redis.Redis(connection_pool=_POOL)
+# Never connected, only used to pack commands the way the pool's would
+_PACKER = _POOL.connection_class(**_POOL.connection_kwargs)
+META_EXPIRE = 86400
+_cache_page = r.register_script("""
+redis.call('SETEX', KEYS[1], ARGV[1], ARGV[2])
+if KEYS[2] and redis.call('GET', KEYS[2]) == ARGV[3] then
+    redis.call('DEL', KEYS[2])
+end
+return 1
+""")
+_release_lock = r.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+LOCAL_CACHE_SIZE = 1024
+_local = OrderedDict()
+_local_lock = threading.Lock()
+FLUSH_INTERVAL = 0.1
+_REPLY_OFF = True
+_pending = Counter()
+_pending_lock = threading.Lock()
+_writes = queue.Queue(maxsize=10000)
+_workers = {}
+_workers_lock = threading.Lock()
+_exit_hooks = set()
+logger = logging.getLogger(__name__)
+_COUNT_AND_GET = """
+redis.call('INCR', KEYS[2])
+local page = redis.call('GET', KEYS[1])
+local stale = false
+if not page and KEYS[3] then
+    stale = redis.call('GET', KEYS[3])
+end
+return {page, redis.call('PTTL', KEYS[1]), stale}
+"""
+_count_and_get = r.register_script(_COUNT_AND_GET)
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+_HTTP_TIMEOUT = httpx.Timeout(10, connect=3.05)
+_HTTP_RETRIES = 2
+_HTTP = httpx.Client(
+    follow_redirects=True,
+    timeout=_HTTP_TIMEOUT,
+    transport=httpx.HTTPTransport(
+        http2=True, limits=_HTTP_LIMITS, retries=_HTTP_RETRIES
+    ),
+)
+# A cold fetch keeps its lock through every connect attempt and the read,
+# plus a margin, and waiters give up on the same deadline
+LOCK_TIMEOUT = math.ceil(
+    _HTTP_TIMEOUT.connect * (1 + _HTTP_RETRIES) + _HTTP_TIMEOUT.read
+) + 5
+# Async connections belong to the event loop that opened them
+_async_clients = {}
+
+
+def _async_client() -> Tuple[aioredis.Redis, Any, httpx.AsyncClient]:
+    """Get the async Redis client, its count-and-get script and the HTTP
+    client of the running event loop, creating them on its first use"""
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.get(loop)
+    if clients is None:
+        for closed in [old for old in _async_clients if old.is_closed()]:
+            del _async_clients[closed]
+        if _REDIS_SOCKET:
+            pool = aioredis.BlockingConnectionPool.from_url(
+                f"unix://{_REDIS_SOCKET}",
+                max_connections=64,
+                timeout=10,
+                socket_timeout=5,
+                health_check_interval=30,
+            )
+        else:
+            pool = aioredis.BlockingConnectionPool.from_url(
+                "redis://localhost",
+                max_connections=64,
+                timeout=10,
+                socket_timeout=5,
+                socket_connect_timeout=5,
+                socket_keepalive=True,
+                health_check_interval=30,
+            )
+        async_r = aioredis.Redis(connection_pool=pool)
+        clients = _async_clients[loop] = (
+            async_r,
+            async_r.register_script(_COUNT_AND_GET),
+            httpx.AsyncClient(
+                http2=True,
+                follow_redirects=True,
+                limits=_HTTP_LIMITS,
+                timeout=_HTTP_TIMEOUT,
+            ),
+        )
+    return clients
+
+
+@lru_cache(maxsize=4096)
+def _url_digest(url: str) -> str:
+    """Hash a URL with 128-bit BLAKE2b, remembering the recent ones"""
+    return hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
 
 
 def safe_key(prefix: str, url: str) -> str:
-    """Generate a safe Redis key using SHA-256"""
-    return f"{prefix}:{hashlib.sha256(url.encode()).hexdigest()}"
+    """Generate a safe Redis key from a hash of the URL
+
+    The hash is wrapped in a Redis Cluster hash tag, so the page, count
+    and lock keys of one URL share a slot and can still be used together
+    in one script or MGET; different URLs spread over the whole cluster.
+    """
+    return f"{prefix}:{{{_url_digest(url)}}}"
+
+
+@lru_cache(maxsize=4096)
+def _page_keys(url: str) -> Tuple[bytes, bytes, bytes]:
+    """Build the encoded cache, count and meta keys of a URL once"""
+    return (
+        safe_key("cachedm", url).encode(),
+        safe_key("count", url).encode(),
+        safe_key("meta", url).encode(),
+    )
+
+
+def _pack_page(html: bytes, expire: int) -> bytes:
+    """Frame a compressed page body with its fetch time and lifetime"""
+    return msgpack.packb(
+        {"t": time.time(), "e": expire, "b": zlib.compress(html, 1)},
+        use_bin_type=True,
+    )
+
+
+def _unpack_page(cached: bytes) -> bytes:
+    """Extract the page body from a value cached in Redis"""
+    return zlib.decompress(msgpack.unpackb(cached, raw=False)["b"])
+
+
+def _local_get(url: str) -> Optional[bytes]:
+    """Look a page up in the in-process cache, dropping it if expired"""
+    with _local_lock:
+        entry = _local.get(url)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del _local[url]
+            return None
+        _local.move_to_end(url)
+        return entry[1]
+
+
+def _local_put(url: str, html: bytes, ttl: float) -> None:
+    """Keep a page in the in-process cache for ttl seconds"""
+    with _local_lock:
+        _local[url] = (time.monotonic() + ttl, html)
+        _local.move_to_end(url)
+        if len(_local) > LOCAL_CACHE_SIZE:
+            _local.popitem(last=False)
+
+
+def _start_worker(target: Callable, at_exit: Callable) -> None:
+    """Start a background worker the first time it is needed"""
+    if target in _workers:
+        return
+    with _workers_lock:
+        if target not in _workers:
+            _workers[target] = threading.Thread(target=target, daemon=True)
+            _workers[target].start()
+            if at_exit not in _exit_hooks:
+                _exit_hooks.add(at_exit)
+                atexit.register(at_exit)
+
+
+def _reset_after_fork() -> None:
+    """Give a forked child its own locks, queues and workers
+
+    The child inherits the parent's state but none of its threads, so
+    nothing would drain the queued writes, and the parent still owns
+    the pending counts it is about to flush.
+    """
+    global _local_lock, _pending, _pending_lock, _writes, _workers_lock
+    _local_lock = threading.Lock()
+    _pending = Counter()
+    _pending_lock = threading.Lock()
+    _writes = queue.Queue(maxsize=10000)
+    _workers.clear()
+    _workers_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _count_later(count_key: bytes) -> None:
+    """Add one access to a count that the flusher will send to Redis"""
+    _start_worker(_flusher, _flush_counts)
+    with _pending_lock:
+        _pending[count_key] += 1
+
+
+def _pack(*args) -> bytes:
+    """Pack a command into its on-wire bytes with redis-py's packer"""
+    return b"".join(_PACKER.pack_command(*args))
+
+
+_REPLY_OFF_FRAME = _pack("CLIENT", "REPLY", "OFF")
+_REPLY_ON_FRAME = _pack("CLIENT", "REPLY", "ON")
+
+
+@lru_cache(maxsize=4096)
+def _incrby_frame(count_key: bytes, hits: int) -> bytes:
+    """Pack INCRBY count_key hits, remembering the recent ones"""
+    return _pack("INCRBY", count_key, hits)
+
+
+def _refuses_client(error: redis.ResponseError) -> bool:
+    """Tell whether an error means CLIENT is disabled or not allowed"""
+    message = str(error).lower()
+    return (
+        isinstance(error, redis.exceptions.NoPermissionError)
+        or "unknown command" in message
+        or "unknown subcommand" in message
+    )
+
+
+def _flush_counts() -> None:
+    """Send the pending access counts as a batch of INCRBYs
+
+    The batch goes out on a dedicated connection, between CLIENT REPLY
+    OFF and ON so only the closing OK is read back. If the server refuses
+    CLIENT REPLY the INCRBYs have still been applied, so the connection
+    is dropped and later batches are sent with their replies on, which
+    lets errors such as READONLY be seen and logged per INCRBY. Counts
+    are only put back when no connection could be had; once the batch
+    is sent, a failure may have applied any part of it, so it is dropped
+    rather than risk counting the same hits twice.
+    """
+    global _pending, _REPLY_OFF
+    with _pending_lock:
+        if not _pending:
+            return
+        snapshot, _pending = _pending, Counter()
+    try:
+        conn = r.connection_pool.get_connection("INCRBY")
+    except redis.RedisError:
+        logger.exception("Flushing access counts failed")
+        with _pending_lock:
+            _pending.update(snapshot)
+        return
+    frames = [
+        _incrby_frame(count_key, hits)
+        for count_key, hits in snapshot.items()
+    ]
+    try:
+        if _REPLY_OFF:
+            conn.send_packed_command([
+                b"".join(chain([_REPLY_OFF_FRAME], frames, [_REPLY_ON_FRAME]))
+            ])
+            conn.read_response()
+        else:
+            conn.send_packed_command([b"".join(frames)])
+            failed = []
+            for _ in frames:
+                try:
+                    conn.read_response()
+                except redis.ResponseError as error:
+                    failed.append(error)
+            if failed:
+                logger.error(
+                    "Dropped %d of %d access counts: %s",
+                    len(failed), len(frames), failed[0],
+                )
+    except redis.ResponseError as error:
+        # Only CLIENT REPLY OFF itself can answer with replies off
+        if _refuses_client(error):
+            logger.warning("Sending access counts with replies on: %s", error)
+            _REPLY_OFF = False
+        else:
+            logger.error("Dropped %d access counts: %s", len(frames), error)
+        conn.disconnect()
+    except redis.RedisError:
+        logger.exception("Dropped %d access counts", len(snapshot))
+        conn.disconnect()
+    except BaseException:
+        conn.disconnect()
+        raise
+    finally:
+        r.connection_pool.release(conn)
+
+
+def _flusher() -> None:
+    """Flush the pending access counts every FLUSH_INTERVAL seconds"""
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        _flush_counts()
+
+
+def _store_page(keys: list, expire: int, html: bytes,
+                token: Optional[str] = None) -> None:
+    """Compress a page into Redis, releasing its fetch lock if still ours"""
+    args = [expire, _pack_page(html, expire)]
+    if token is not None:
+        args.append(token)
+    _cache_page(keys=keys, args=args)
+
+
+def _store_meta(meta_key: bytes, etag: Optional[str],
+                modified: Optional[str], html: bytes) -> None:
+    """Keep a page's validators and body around for revalidation"""
+    r.setex(meta_key, META_EXPIRE, msgpack.packb(
+        {"etag": etag, "lm": modified, "b": zlib.compress(html, 1)},
+        use_bin_type=True,
+    ))
+
+
+def _conditional_headers(stale: Optional[bytes]) -> dict:
+    """Build If-None-Match/If-Modified-Since headers from a stale copy"""
+    if not stale:
+        return {}
+    meta = msgpack.unpackb(stale, raw=False)
+    headers = {}
+    if meta["etag"]:
+        headers["If-None-Match"] = meta["etag"]
+    if meta["lm"]:
+        headers["If-Modified-Since"] = meta["lm"]
+    return headers
+
+
+def _revalidated(meta_key: bytes, stale: Optional[bytes], status: int,
+                 headers: Mapping[str, str], body: bytes) -> bytes:
+    """Pick the stale body on a 304, else remember the new validators"""
+    if status == 304 and stale:
+        _write_later(r.expire, meta_key, META_EXPIRE)
+        return zlib.decompress(msgpack.unpackb(stale, raw=False)["b"])
+    etag = headers.get("ETag")
+    modified = headers.get("Last-Modified")
+    if etag or modified:
+        _write_later(_store_meta, meta_key, etag, modified, body)
+    return body
+
+
+def _run_write(write: Callable, *args) -> None:
+    """Run a background Redis write, logging whatever makes it fail"""
+    try:
+        write(*args)
+    except Exception:
+        logger.exception("Background Redis write failed")
+
+
+def _write_behind() -> None:
+    """Run the queued Redis writes in the background, in order"""
+    while True:
+        write, args = _writes.get()
+        try:
+            _run_write(write, *args)
+        finally:
+            _writes.task_done()
+
+
+def _join_writes() -> None:
+    """Wait for the queued writes of this process to be done"""
+    _writes.join()
+
+
+def _write_later(write: Callable, *args) -> None:
+    """Queue a Redis write, or run it right away if the queue is full
+
+    Inside an event loop a write that does not fit is handed to the
+    loop's executor instead, so it never blocks the loop.
+    """
+    _start_worker(_write_behind, _join_writes)
+    try:
+        _writes.put_nowait((write, args))
+    except queue.Full:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            write(*args)
+        else:
+            loop.run_in_executor(None, _run_write, write, *args)
+
+
+def _batched(items: Iterable, size: int) -> Iterator[list]:
+    """Split an iterable into lists of at most size items"""
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _wait_for(cache_key: bytes, timeout: float) -> Optional[bytes]:
+    """Poll the cache with backoff until a key shows up or time runs out"""
+    deadline = time.monotonic() + timeout
+    for delay in chain((0.005, 0.02), repeat(0.05)):
+        if time.monotonic() + delay > deadline:
+            return None
+        time.sleep(delay)
+        cached = r.get(cache_key)
+        if cached:
+            return cached
 
 
 def count_and_cache(expire: int = 10) -> Callable:
-    """Decorator to count access and cache HTML"""
+    """Decorator to count access and cache HTML as bytes"""
     def decorator(func: Callable) -> Callable:
-        @wraps(func)
-        def wrapper(url: str) -> str:
-            cache_key = safe_key("cached", url)
-            count_key = safe_key("count", url)
-
-            cached = r.get(cache_key)
-            if cached:
-                return cached.decode("utf-8")
+        inflight = {}
+        inflight_lock = threading.Lock()
 
-            # Count access
-            r.incr(count_key)
+        def fetch(url: str, cache_key: bytes) -> bytes:
+            """Fetch a cold page under a Redis lock shared by all processes"""
+            # Let a single process fetch the page, the others wait for it
+            lock_key = safe_key("lock", url)
+            token = os.urandom(16).hex()
+            locked = r.set(lock_key, token, nx=True, ex=LOCK_TIMEOUT)
+            if not locked:
+                cached = _wait_for(cache_key, LOCK_TIMEOUT)
+                if cached:
+                    return _unpack_page(cached)
 
-            html = func(url)
+            try:
+                html = func(url)
+            except BaseException:
+                if locked:
+                    _release_lock(keys=[lock_key], args=[token])
+                raise
 
             # تأكدي إن اللي بيتخزن هو string متكوّد
             if isinstance(html, str):
                 html = html.encode('utf-8')
 
-            r.setex(cache_key, expire, html)
+            # Cache the page and release the lock without waiting on it
+            _local_put(url, html, expire)
+            if locked:
+                _write_later(
+                    _store_page, [cache_key, lock_key], expire, html, token
+                )
+            else:
+                _write_later(_store_page, [cache_key], expire, html)
+            return html
+
+        @wraps(func)
+        def wrapper(url: str) -> bytes:
+            cache_key, count_key, _ = _page_keys(url)
+
+            # Recently seen pages are served from memory, counted in batches
+            html = _local_get(url)
+            if html is not None:
+                _count_later(count_key)
+                return html
+
+            # Count access and look the page up in one atomic round-trip
+            cached, ttl, _ = _count_and_get(keys=[cache_key, count_key])
+            if cached:
+                html = _unpack_page(cached)
+                if ttl > 0:
+                    _local_put(url, html, ttl / 1000)
+                return html
+
+            # Let one thread per process fetch a cold page, the rest share it
+            with inflight_lock:
+                future = inflight.get(url)
+                leader = future is None
+                if leader:
+                    future = inflight[url] = Future()
+            if not leader:
+                return future.result()
 
-            return html.decode('utf-8')
+            try:
+                html = fetch(url, cache_key)
+            except BaseException as exc:
+                future.set_exception(exc)
+                raise
+            else:
+                future.set_result(html)
+            finally:
+                with inflight_lock:
+                    del inflight[url]
+            return html
         return wrapper
     return decorator
 
 
 @count_and_cache(10)
+def get_page_bytes(url: str) -> bytes:
+    """Fetch raw page content, revalidating a stale copy if there is one"""
+    meta_key = _page_keys(url)[2]
+    stale = r.get(meta_key)
+    response = _HTTP.get(url, headers=_conditional_headers(stale))
+    return _revalidated(
+        meta_key, stale, response.status_code, response.headers,
+        response.content,
+    )
+
+
 def get_page(url: str) -> str:
     """Fetch page content"""
-    response = requests.get(url)
-    return response.text
+    return get_page_bytes(url).decode("utf-8", "replace")
+
+
+def get_cache_info(url: str) -> dict:
+    """Report whether a page is cached, for how long, and its access count"""
+    cache_key, count_key, _ = _page_keys(url)
+
+    cached, count = r.mget(cache_key, count_key)
+    with _pending_lock:
+        count = int(count or 0) + _pending[count_key]
+
+    ttl = 0
+    if cached:
+        page = msgpack.unpackb(cached, raw=False)
+        ttl = max(int(page["t"] + page["e"] - time.time()), 0)
+
+    return {
+        "cached": bool(cached),
+        "ttl": ttl,
+        "count": count,
+    }
+
+
+def clear_cache() -> int:
+    """Drop every cached page and its validators, keeping the counts"""
+    with _local_lock:
+        _local.clear()
+    cleared = 0
+    keys = chain(
+        r.scan_iter(match="cachedm:*", count=500),
+        r.scan_iter(match="meta:*", count=500),
+    )
+    # One UNLINK per key, as keys of different URLs live in other slots
+    for batch in _batched(keys, 500):
+        with r.pipeline(transaction=False) as pipe:
+            for key in batch:
+                pipe.unlink(key)
+            cleared += sum(pipe.execute())
+    return cleared
+
+
+async def get_page_async(url: str, expire: int = 10) -> str:
+    """Fetch page content without blocking the event loop"""
+    cache_key, count_key, meta_key = _page_keys(url)
+
+    html = _local_get(url)
+    if html is not None:
+        _count_later(count_key)
+        return html.decode("utf-8", "replace")
+
+    _, async_count_and_get, http = _async_client()
+    cached, ttl, stale = await async_count_and_get(
+        keys=[cache_key, count_key, meta_key],
+    )
+    if cached:
+        html = _unpack_page(cached)
+        if ttl > 0:
+            _local_put(url, html, ttl / 1000)
+        return html.decode("utf-8", "replace")
+
+    response = await http.get(url, headers=_conditional_headers(stale))
+    html = _revalidated(
+        meta_key, stale, response.status_code, response.headers,
+        response.content,
+    )
+    _local_put(url, html, expire)
+    _write_later(_store_page, [cache_key], expire, html)
+
+    return html.decode("utf-8", "replace")
+
+
+async def get_pages_async(urls: Iterable[str]) -> List[str]:
+    """Fetch the content of several pages concurrently"""
+    return await asyncio.gather(*(get_page_async(url) for url in urls))